@@ -2,22 +2,47 @@
 # File name: parse_mbox.py
 # Description: Parse .mbox file. Decode options are base64 and quoted-printable for charsets of UTF-8 and ISO-2022-JP(JIS)
 # Usage: python3 parse_mbox.py -i mails.mbox -o test.xlsx
+#        python3 parse_mbox.py -i mails.mbox -o test.xlsx --fast-parser   (split on "From " lines, parse with BytesParser)
+#        python3 parse_mbox.py -i mails.mbox -o test.xlsx --parallel --workers 4   (parse in worker processes)
 # Version: Python 3.8.10
 # Author: Yuya Okumura
 # Date: 02-12-2021
 
 import mailbox
-from typing import Dict, List, Literal, Any
-import bs4
-import base64
+import email.errors
+import email.message
+import email.policy
+from email.parser import BytesParser
+from email.header import decode_header, make_header
+from lxml import etree
+from lxml import html as lxml_html
 import re
-import quopri
 import xlsxwriter
 import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import sys
 import logging
 from logging import critical, error, info, warning, debug
 import traceback
+from collections import deque
+
+# chain emails can be divided in to parts by spliting with 'From:' notation
+_CHAINED_EMAIL_RE = re.compile(r'..From:')
+
+# line breaks stripped from the decoded body text
+_CRLF_STRIP = str.maketrans('', '', '\r\n')
+
+# transfer encodings and charsets of text/plain parts we decode
+_READABLE_ENCODINGS = frozenset({'base64', 'quoted-printable'})
+_READABLE_CHARSETS = frozenset({'utf-8', 'iso-2022-jp', 'iso-8859-2', 'us-ascii'})
+
+# read buffer for the .mbox file, so large mailboxes are read in few big chunks
+_READ_BUFFER_SIZE = 16 * 1024 * 1024
+
+# charsets we know how to decode, picked out of the Content-Type header
+_CHARSET_RE = re.compile(r'(utf-8|iso-2022-jp|iso-8859-2|us-ascii)', re.IGNORECASE)
 
 
 def parse_arguments():
@@ -29,6 +54,12 @@ def parse_arguments():
                         help='Provide .mbox file to parse')
     parser.add_argument('-o', metavar='output', type=str, required=True,
                         help="Provide a .xlsx file for output")
+    parser.add_argument('--fast-parser', action='store_true',
+                        help='Split the .mbox on "From " lines and parse with BytesParser instead of mailbox.mbox')
+    parser.add_argument('--parallel', action='store_true',
+                        help='Parse emails in worker processes (implies the BytesParser splitter)')
+    parser.add_argument('--workers', metavar='workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes used with --parallel')
 
     args = parser.parse_args()
     verbose = {0: logging.CRITICAL, 1: logging.ERROR,
@@ -41,127 +72,99 @@ def parse_arguments():
 
 def get_html_text(html):
     try:
-        return bs4.BeautifulSoup(html, 'lxml').body.get_text(' ', strip=True)
-    except AttributeError:  # message contents empty
+        return ' '.join(lxml_html.fromstring(html).text_content().split())
+    except (ValueError, etree.ParserError):  # message contents empty
         return None
 
 
-class Decoder(object):
-    def __init__(self, msg: str, charset: Literal['utf-8', 'iso-2022-jp', 'iso-8859-2', 'us-ascii'], transfer_method: Literal['base64', 'quoted-printable']):
-        self.msg = msg
-        self.charset = charset
-        self.transfer_method = transfer_method
-        self.bynary = self._encode_charset()
-
-    def call(self):
-        decoded_transfer = self._decode_with_transfer()
-        return self._decode_charset(decoded_transfer)
-
-    def _encode_charset(self):
-        return self.msg.encode(self.charset)
-
-    def _decode_charset(self, msg: bytes):
-        return msg.decode(self.charset)
-
-    def _decode_with_transfer(self):
-        if self.transfer_method == 'base64':
-            return self._decode_with_base64()
-        elif self.transfer_method == 'quoted-printable':
-            return self._decode_with_quoted_printable()
-
-    def _decode_with_base64(self):
-        return base64.b64decode(self.bynary)
-
-    def _decode_with_quoted_printable(self):
-        return quopri.decodestring(self.bynary)
-
-
-class EmailDecoder(Decoder):
-    def __init__(self, msg: str, charset: Literal['utf-8', 'iso-2022-jp', 'iso-8859-2', 'us-ascii'], transfer_method: Literal['base64', 'quoted-printable']):
-        super().__init__(msg, charset, transfer_method)
-        # chain emails can be divided in to parts by spliting with 'From:' notation
-        chained_email = r'..From:'
-
-        self.regex = re.compile(chained_email)
-
-    def fetch_first_email(self):
-        decoded_text = super().call()
-        text_wo_re = self.regex.split(decoded_text)
-        return text_wo_re[0].replace('\r', '').replace('\n', '')
-
-
-class SubjectDecoder(Decoder):
-    def __init__(self, subject: str):
-        self.regex = self._set_regex()
-        self.subject = subject
-
-    def _set_regex(self):
-        # .mbox contains subject encoded in the format
-        # where first argument explains charset and encode method (=?UTF-8?Q?)
-        # e.g. subject: =?UTF-8?Q?Marqu=C3=A9s_de_Vargas_=26_Baud?=
-        # Q for quoted-printable B for base64
-        regex = r"""
-        \=\?
-        (utf\-8|iso\-2022\-jp)    # charset
-        \?                        
-        .                         # encode-transfer-method 
-        \?"""
-        return re.compile(regex, re.VERBOSE)
-
-    def call(self):
-        if not self._is_required_to_decode():
-            return self.subject
-
-        return self._decode_subject()
-
-    def _decode_subject(self):
-        lines = self.subject.split("\n")
-        decoded_subject = []
-        for line in lines:
-            # regex takes at least 10 chars, so < 10 is not a target
-            if len(line) < 10:
-                continue
-            encoding = self._identify_decode_method(line)
-            decoded_subject.append(self._decode_line(encoding))
-        return ''.join(decoded_subject)
-
-    def _decode_line(self, obj: Dict[str, str]):
-        super().__init__(obj['text'], obj['charset'], obj['transfer_method'])
-        return super().call()
-
-    def _is_required_to_decode(self):
-        return self.regex.search(self.subject) is not None
-
-    def _identify_decode_method(self, line: str):
-        line = line.strip()
-        search = self.regex.search(line)
-        charset = search.group(1)
-        decoded_way_char = search.group(0)[-2]
-
-        transfer_method = ''
-        if decoded_way_char == 'B':
-            transfer_method = 'base64'
-        else:
-            transfer_method = 'quoted-printable'
-
-        decodable_text = self.regex.split(line)[-1]
-        return {"transfer_method": str(transfer_method), "charset": str(charset), "text": str(decodable_text)}
+def fetch_first_email(text):
+    # keep only the text before the first chained 'From:' and drop line breaks
+    match = _CHAINED_EMAIL_RE.search(text)
+    first = text if match is None else text[:match.start()]
+    return first.translate(_CRLF_STRIP)
+
+
+class BufferedMbox(mailbox.mbox):
+    def __init__(self, path, factory=None, create=True):
+        super().__init__(path, factory, create)
+        # reopen the file mailbox.mbox opened with default buffering (read only, we never write back)
+        self._file.close()
+        self._file = open(self._path, 'rb', buffering=_READ_BUFFER_SIZE)
+
+
+def iter_mbox_messages(path):
+    # messages in .mbox are delimited by lines starting with 'From ' (envelope line)
+    parser = BytesParser(policy=email.policy.compat32)
+    with open(path, 'rb', buffering=_READ_BUFFER_SIZE) as f:
+        lines = None
+        for line in f:
+            if line.startswith(b'From '):
+                if lines is not None:
+                    yield parser.parsebytes(b''.join(lines))
+                lines = []
+            elif lines is not None:
+                lines.append(line)
+        if lines is not None:
+            yield parser.parsebytes(b''.join(lines))
+
+
+def find_message_offsets(path):
+    # (start, end) byte offsets of each message, start pointing at its 'From ' line
+    offsets = []
+    start = None
+    pos = 0
+    with open(path, 'rb', buffering=_READ_BUFFER_SIZE) as f:
+        for line in f:
+            if line.startswith(b'From '):
+                if start is not None:
+                    offsets.append((start, pos))
+                start = pos
+            pos += len(line)
+    if start is not None:
+        offsets.append((start, pos))
+    return offsets
+
+
+def parse_chunk(path, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    # drop the 'From ' envelope line
+    eol = chunk.find(b'\n')
+    body = chunk[eol + 1:] if eol != -1 else b''
+    email_obj = BytesParser(policy=email.policy.compat32).parsebytes(body)
+    return GmailMboxMessage(email_obj).parse_email()
+
+
+def parse_mbox_parallel(path, workers):
+    offsets = find_message_offsets(path)
+    starts = [start for start, _ in offsets]
+    ends = [end for _, end in offsets]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # map keeps the mbox order of the results
+        results = executor.map(partial(parse_chunk, path), starts, ends, chunksize=64)
+        try:
+            yield from results
+        finally:
+            # when the consumer stops early, closing map's iterator cancels the
+            # chunks not yet started, so the executor exit does not parse the rest
+            results.close()
 
 
 class GmailMboxMessage():
     def __init__(self, email_data):
-        if not isinstance(email_data, mailbox.mboxMessage):
-            raise TypeError('Variable must be type mailbox.mboxMessage')
+        if not isinstance(email_data, email.message.Message):
+            raise TypeError('Variable must be type email.message.Message')
         self.email_data = email_data
 
     def parse_email(self):
         email_date = self.email_data['Date']
         email_from = self.email_data['From']
         email_to = self.email_data['To']
-        email_subject = SubjectDecoder(str(self.email_data['Subject'])).call()
-        content = self._read_email_payload()[0]
-        print("\nDate: ", email_date, "\nFrom: ", email_from, "\nTo: ",
-              email_to, "\nSubject: ", email_subject, "\nContent: ", content)
+        email_subject = self._decode_subject()
+        content = self._read_email_text(self._fetch_body_part())
+        debug("Date: %s From: %s To: %s Subject: %s",
+              email_date, email_from, email_to, email_subject)
 
         content_type = content[0]
         charset = content[1]
@@ -169,63 +172,63 @@ class GmailMboxMessage():
         text = content[3]
         return {'Date': email_date, 'From': email_from, 'To': email_to, 'Subject': email_subject, 'Content_type': content_type, 'Charset': charset, 'Transfer': transfer, 'Text': text}
 
-    def _read_email_payload(self):
-        email_payload = self.email_data.get_payload()
-        if self.email_data.is_multipart():
-            email_messages = list(self._get_email_messages(email_payload))
-        else:
-            email_messages = [email_payload]
-        return [self._read_email_text(msg) for msg in email_messages]
+    def _decode_subject(self):
+        subject = self.email_data['Subject']
+        # decode RFC 2047 encoded-words (e.g. =?UTF-8?Q?Marqu=C3=A9s_de_Vargas_=26_Baud?=)
+        try:
+            return str(make_header(decode_header(subject or '')))
+        except (LookupError, UnicodeDecodeError, email.errors.HeaderParseError):
+            # unknown charset or broken payload: keep the subject as it is
+            return str(subject)
+
+    def _fetch_body_part(self):
+        # the first text/plain part carries the body, otherwise report the first part
+        if not self.email_data.is_multipart():
+            return self.email_data
+        parts = list(self._get_email_messages(self.email_data.get_payload()))
+        for part in parts:
+            if part.get_content_type() == 'text/plain':
+                return part
+        return parts[0] if parts else self.email_data
 
     def _get_email_messages(self, email_payload):
-        for msg in email_payload:
+        # depth-first walk over nested payloads, keeping the original part order
+        stack = deque(email_payload)
+        while stack:
+            msg = stack.popleft()
             if isinstance(msg, (list, tuple)):
-                for submsg in self._get_email_messages(msg):
-                    yield submsg
+                stack.extendleft(reversed(msg))
             elif msg.is_multipart():
-                for submsg in self._get_email_messages(msg.get_payload()):
-                    yield submsg
+                stack.extendleft(reversed(msg.get_payload()))
             else:
                 yield msg
 
-    def _fetch_content_type(self, msg):
-        return 'NA' if isinstance(msg, str) else msg.get_content_type()
-
-    def _fetch_charset(self, msg):
-        charset = 'NA' if isinstance(
-            msg, str) else msg.get('Content-Type', 'NA')
-        if "utf-8" in charset.lower():
-            charset = "utf-8"
-        if "iso-2022-jp" in charset.lower():
-            charset = "iso-2022-jp"
-        if "iso-8859-2" in charset.lower():
-            charset = "iso-8859-2"
-        if "us-ascii" in charset.lower():
-            charset = "us-ascii"
-        return charset
-
-    def _fetch_encoding_method(self, msg):
-        return 'NA' if isinstance(msg, str) else msg.get(
-            'Content-Transfer-Encoding', 'NA')
+    def _fetch_charset(self, content_type_header):
+        match = _CHARSET_RE.search(content_type_header)
+        return match.group(1).lower() if match else content_type_header
 
     def _create_readable_text(self, msg, content_type, encoding, charset):
         if self._is_readable_text(content_type, encoding, charset):
-            return EmailDecoder(
-                msg.get_payload(), charset, encoding).fetch_first_email()
+            # get_payload(decode=True) undoes base64/quoted-printable and returns bytes
+            text = msg.get_payload(decode=True).decode(charset, errors='replace')
+            return fetch_first_email(text)
         else:
             return 'NA'
 
     def _read_email_text(self, msg):
-        content_type = self._fetch_content_type(msg)
-        encoding = self._fetch_encoding_method(msg)
-        charset = self._fetch_charset(msg)
+        get = msg.get
+        content_type = msg.get_content_type()
+        encoding = get('Content-Transfer-Encoding')
+        encoding = encoding.lower() if encoding else 'NA'
+        charset = self._fetch_charset(get('Content-Type', 'NA'))
         msg_text = self._create_readable_text(
             msg, content_type, encoding, charset)
 
         return (content_type, charset,  encoding, msg_text)
 
     def _is_readable_text(self, content_type, encoded_way, charset):
-        return True if 'text/plain' in content_type.lower() and encoded_way.lower() in ['base64', 'quoted-printable'] and charset in ['utf-8', 'iso-2022-jp', 'iso-8859-2', 'us-ascii'] else False
+        # content_type comes from get_content_type() and encoded_way is lowercased in _read_email_text
+        return content_type == 'text/plain' and encoded_way in _READABLE_ENCODINGS and charset in _READABLE_CHARSETS
 
 
 class ExcelSheet():
@@ -235,7 +238,6 @@ class ExcelSheet():
         self.row = 0
 
     def call(self, content):
-
         self._set_content(content)
         if self.row == 0:
             self._write_title()
@@ -249,41 +251,45 @@ class ExcelSheet():
         self.content = content
 
     def _fetch_titles(self):
-        l = []
-        for title in self.content.keys():
-            l.append(title)
-        return l
+        return list(self.content.keys())
 
     def _write_title(self):
-        column = 0
-        titles = self._fetch_titles()
-        for title in titles:
-            self.worksheet.write(self.row, column, title)
-            column += 1
+        self.worksheet.write_row(self.row, 0, self._fetch_titles())
 
     def _write_content(self):
-        column = 0
-        for item in self.content.values():
-            self.worksheet.write(self.row, column, item)
-            column += 1
+        self.worksheet.write_row(self.row, 0, list(self.content.values()))
         self.row += 1
 
 
 def main(args):
+    # constant_memory flushes each row to disk as it is written (rows must be written in order)
+    # strings_to_urls off skips the URL regex xlsxwriter runs on every string
+    workbook = xlsxwriter.Workbook(
+        args.o, {'constant_memory': True, 'strings_to_urls': False})
+    worksheet = workbook.add_worksheet()
+    spreadsheet = ExcelSheet(worksheet)
+    contents = None
     try:
-        mbox_obj = mailbox.mbox(args.i)
-        workbook = xlsxwriter.Workbook(args.o)
-        worksheet = workbook.add_worksheet()
-        spreadsheet = ExcelSheet(worksheet)
-        num_entries = len(mbox_obj)
+        num_entries = None
+        if args.parallel:
+            contents = parse_mbox_parallel(args.i, args.workers)
+        else:
+            if args.fast_parser:
+                email_objs = iter_mbox_messages(args.i)
+            else:
+                mbox_obj = BufferedMbox(args.i)
+                # mailbox indexes the whole file before iterating anyway, so the count is free
+                num_entries = len(mbox_obj)
+                email_objs = mbox_obj.itervalues()
+            contents = (GmailMboxMessage(email_obj).parse_email()
+                        for email_obj in email_objs)
 
         i = 0
-        for idx, email_obj in enumerate(mbox_obj):
-            email_data = GmailMboxMessage(email_obj)
-            content = email_data.parse_email()
+        for idx, content in enumerate(contents, 1):
             spreadsheet.call(content)
+            progress = idx if num_entries is None else '{0} of {1}'.format(idx, num_entries)
             info(
-                '=-=-=-=-=-=-=-=-=-=-Parsing email {0} of {1}-=-=-=-=-=-=-=-=-=-=-=-=-=-=-'.format(idx+1, num_entries))
+                '=-=-=-=-=-=-=-=-=-=-Parsing email {0}-=-=-=-=-=-=-=-=-=-=-=-=-=-=-'.format(progress))
             # i += 1
             # if i == 10:
             #     break
@@ -291,6 +297,9 @@ def main(args):
         error(str(e))
         traceback.print_exc()
     finally:
+        if contents is not None:
+            # stop the parser (and a --parallel pool) right away if writing failed
+            contents.close()
         workbook.close()
 
 